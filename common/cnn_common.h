@@ -158,3 +158,6 @@ typedef void (*allocator)(Model *model, const ParameterInfo *input[], ParameterI
 // below are defined in ops.c
 extern const handler handlers[];
 extern const allocator allocators[];
+// Call the handler/allocator for node->op_type
+void dispatch_handler(Model *model, const ParameterInfo *input[], ParameterInfo *output, const Node* node);
+void dispatch_allocator(Model *model, const ParameterInfo *input[], ParameterInfo *output, const Node* node);
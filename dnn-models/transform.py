@@ -19,7 +19,10 @@ import onnx.helper
 import numpy as np
 
 from configs import configs
-from utils import extract_data, find_initializer, find_node_by_output, find_tensor_value_info, load_model, get_model_ops, DataLayout
+from utils import (
+    decode_raw_data, extract_data, find_initializer, find_node_by_output, find_tensor_value_info, initializer_index, value_info_index,
+    load_model, get_model_ops, DataLayout,
+)
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -222,6 +225,8 @@ if args.target == 'msp432':
 Constants.LEA_BUFFER_SIZE = lea_buffer_size[args.target]
 
 onnx_model = load_model(config, for_deployment=True)
+# Initializers are only modified in place below, so this index stays valid
+initializers = initializer_index(onnx_model)
 
 names = {}
 
@@ -241,7 +246,7 @@ def replace_squeeze(node, inp):
     # Since opset 13, axes is an input instead of an attribute
     try:
         axes_name = node.input[1]
-        axes = find_initializer(onnx_model, axes_name).int64_data
+        axes = find_initializer(onnx_model, axes_name, index=initializers).int64_data
     except IndexError:
         axes = get_attr(node, 'axes')
     new_dims = [dim for dim_idx, dim in enumerate(inp.dims) if dim_idx not in axes]
@@ -251,7 +256,7 @@ def replace_squeeze(node, inp):
 
 def replace_reshape(node, inp):
     dims_name = node.input[1]
-    new_dims = find_initializer(onnx_model, dims_name).int64_data
+    new_dims = find_initializer(onnx_model, dims_name, index=initializers).int64_data
     assert new_dims
     inp.dims[:] = new_dims
 
@@ -264,7 +269,7 @@ def replace_nodes():
     for n in onnx_model.graph.node:
         if n.op_type not in ('Squeeze', 'Reshape'):
             continue
-        inp = find_initializer(onnx_model, n.input[0])
+        inp = find_initializer(onnx_model, n.input[0], index=initializers)
         if inp:
             replace_handlers[n.op_type](n, inp)
             replaced_nodes_map[n.output[0]] = n.input[0]
@@ -274,7 +279,7 @@ def transpose_gemm(onnx_model: onnx.ModelProto):
         if node.op_type != 'Gemm':
             continue
         transB = get_attr(node, 'transB')
-        B = find_initializer(onnx_model, node.input[1])
+        B = find_initializer(onnx_model, node.input[1], index=initializers)
         if transB != 1 or B is None:
             continue
         data = extract_data(B)
@@ -386,12 +391,12 @@ def extend_for_footprints(n):
 def determine_conv_tile_c(n):
     logger.debug('Determine tile size for Conv node %s', n.name)
 
-    output_value_info = find_tensor_value_info(onnx_model, n.output[0])
-    filter_info = find_initializer(onnx_model, n.input[1])
+    output_value_info = find_tensor_value_info(onnx_model, n.output[0], index=value_infos)
+    filter_info = find_initializer(onnx_model, n.input[1], index=initializers)
     node_flags = n.flags.b.extra.conv
 
     is_separate_tiling = False
-    if not find_initializer(onnx_model, n.input[0]):
+    if not find_initializer(onnx_model, n.input[0], index=initializers):
         input_node = find_node_by_output(onnx_model.graph.node, n.input[0])
         if input_node and input_node.op_type == 'Concat':
             is_separate_tiling = True
@@ -448,8 +453,8 @@ def determine_conv_tile_c(n):
 def determine_gemm_tile_sizes(n):
     logger.debug('Determine tile size for Gemm node %s', n.name)
 
-    A = find_tensor_value_info(onnx_model, n.input[0])
-    B = find_initializer(onnx_model, n.input[1])
+    A = find_tensor_value_info(onnx_model, n.input[0], index=value_infos)
+    B = find_initializer(onnx_model, n.input[1], index=initializers)
     A_shape = A.type.tensor_type.shape
     A_rows = 1  # Not using A_shape.dim[0] here, as it's a symbol "N"
     A_cols = A_shape.dim[1].dim_value
@@ -480,6 +485,8 @@ def determine_gemm_tile_sizes(n):
 
     assert (tile_size_unit * 2) * (node_flags.tile_channel + 2) <= Constants.ARM_PSTATE_LEN
 
+value_infos = value_info_index(onnx_model)
+
 graph = []
 for n in nodes:
     if n.op_type == 'Conv':
@@ -603,13 +610,6 @@ for node in graph:
 
 parameter_info_idx = 0
 
-def decode_raw_data(params):
-    format_char = {
-        onnx.TensorProto.FLOAT: 'f',
-        onnx.TensorProto.INT64: 'q',
-    }[params.data_type]
-    return list(map(lambda t: t[0], struct.iter_unpack(format_char, params.raw_data)))
-
 model_parameters_info = outputs['model_parameters_info']
 for params in parameters:
     if params is None:  # input
@@ -773,46 +773,64 @@ struct Node;
 ''')
 
     # ops
-    output_h.write('\n')
-    for idx, op in enumerate(ops):
-        output_h.write(f'#define Op{op} {idx}\n')
-
-    for op in ops:
-        output_h.write('void alloc_{}(struct Model *model, const struct ParameterInfo *input[], struct ParameterInfo *output, const struct Node* node);\n'.format(op.lower()))
-        output_h.write('void handle_{}(struct Model *model, const struct ParameterInfo *input[], struct ParameterInfo *output, const struct Node* node);\n'.format(op.lower()))
-    output_c.write('const handler handlers[] = {\n')
-    for op in ops:
-        output_c.write(f'    handle_{op},\n'.lower())
-    output_c.write('};\n')
-    output_c.write('const allocator allocators[] = {\n')
-    for op in ops:
-        output_c.write(f'    alloc_{op},\n'.lower())
-    output_c.write('};\n')
-    for op in ops:
+    output_h.write('\n' + ''.join(f'#define Op{op} {idx}\n' for idx, op in enumerate(ops)))
+
+    op_signature = '(struct Model *model, const struct ParameterInfo *input[], struct ParameterInfo *output, const struct Node* node)'
+    output_h.write(''.join(
+        f'void alloc_{op.lower()}{op_signature};\n'
+        f'void handle_{op.lower()}{op_signature};\n'
+        for op in ops
+    ))
+
+    def op_table(table_type, table_name, prefix):
+        return f'const {table_type} {table_name}[] = {{\n' + ''.join(f'    {prefix}_{op.lower()},\n' for op in ops) + '};\n'
+
+    # A switch lets the compiler generate a jump table with direct calls, which
+    # can be inlined with LTO, instead of indirect calls via the tables above
+    def op_dispatcher(func_name, prefix):
+        return (
+            f'\nvoid {func_name}{op_signature} {{\n'
+            '    switch (node->op_type) {\n' +
+            ''.join(f'        case Op{op}: {prefix}_{op.lower()}(model, input, output, node); break;\n' for op in ops) +
+            '        default: ERROR_OCCURRED();\n'
+            '    }\n'
+            '}\n'
+        )
+
+    def default_op_functions(op):
         if op in inplace_update_ops:
-            output_c.write(textwrap.dedent(f'''
+            ret = textwrap.dedent(f'''
                 void alloc_{op.lower()}(struct Model *model, const struct ParameterInfo *[], struct ParameterInfo *output, const struct Node*) {{
                     SlotInfo *cur_slot_info = get_slot_info(model, output->slot);
                     if (cur_slot_info) {{
                         cur_slot_info->user = model->layer_idx;
                     }}
                 }}
-            '''))
+            ''')
         else:
-            output_c.write(textwrap.dedent(f'''
+            ret = textwrap.dedent(f'''
                 #if defined(__GNUC__) || defined(__clang__)
                 void __attribute__((weak)) alloc_{op.lower()}(struct Model *model, const struct ParameterInfo *[], struct ParameterInfo *output, const struct Node*) {{
                     ERROR_OCCURRED();
                 }}
                 #endif
-            '''))
-        output_c.write(textwrap.dedent(f'''
+            ''')
+        ret += textwrap.dedent(f'''
             #if defined(__GNUC__) || defined(__clang__)
             void __attribute__((weak)) handle_{op.lower()}(struct Model *model, const struct ParameterInfo *[], struct ParameterInfo *output, const struct Node*) {{
                 ERROR_OCCURRED();
             }}
             #endif
-        '''))
+        ''')
+        return ret
+
+    output_c.write(
+        op_table('handler', 'handlers', 'handle') +
+        op_table('allocator', 'allocators', 'alloc') +
+        op_dispatcher('dispatch_handler', 'handle') +
+        op_dispatcher('dispatch_allocator', 'alloc') +
+        ''.join(map(default_op_functions, ops))
+    )
 
     # data
     for idx, name in enumerate(other_flags):
@@ -830,11 +848,7 @@ extern const uint8_t * const {var_name};
         output_c.write(f'''
 const uint8_t _{var_name}[{len(data)}] = {{
 ''')
-        n_pieces, remaining = divmod(len(data), 16)
-        for idx in range(n_pieces):
-            output_c.write(hex_str(data[idx*16:(idx+1)*16]))
-        if remaining:
-            output_c.write(hex_str(data[len(data) - remaining:len(data)]))
+        output_c.write(''.join(hex_str(data[idx:idx+16]) for idx in range(0, len(data), 16)))
         output_c.write(f'''}};
 const uint8_t * const {var_name} = _{var_name};
 ''')
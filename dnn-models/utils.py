@@ -5,7 +5,6 @@ import logging
 import os.path
 import pathlib
 import pickle
-import struct
 import sys
 import tarfile
 import zipfile
@@ -81,23 +80,40 @@ def load_data_cifar10(start: int, limit: int) -> ModelData:
     if limit is None:
         limit = len(test_data[b'labels'])
     labels = test_data[b'labels'][start:start+limit]
-    images = []
     H = 32
     W = 32
-    for im_data in test_data[b'data'][start:start+limit]:
-        # ONNX models transformed from Keras ones uses NHWC as input
-        im = np.array(im_data)
-        im = np.reshape(im, (3, H, W))
-        im = im / 256
-        im = np.moveaxis(im, 0, -1)
-        images.append(im)
+    images = np.reshape(test_data[b'data'][start:start+limit], (-1, 3, H, W))
+    # ONNX models transformed from Keras ones uses NHWC as input
+    images = np.ascontiguousarray(np.moveaxis(images, 1, -1), dtype=np.float32)
+    images /= 256
     # XXX: the actual data layout is NCHW, while the first node is Transpose - take the resultant
-    return ModelData(labels=labels, images=np.array(images, dtype=np.float32), data_layout=DataLayout.NHWC)
+    return ModelData(labels=labels, images=images, data_layout=DataLayout.NHWC)
 
 GOOGLE_SPEECH_URL = 'https://storage.googleapis.com/download.tensorflow.org/data/speech_commands_test_set_v0.02.tar.gz'
 GOOGLE_SPEECH_SAMPLE_RATE = 16000
 
 def load_data_google_speech(start: int, limit: int) -> ModelData:
+    # Computing MFCCs requires starting TensorFlow and running the Mfcc op for
+    # each sample, so the results are cached
+    xdg_cache_home = platformdirs.user_cache_path()
+    filename = f'speech_commands_v0.02_mfcc_{start}_{limit}.npz'
+    local_path = xdg_cache_home / filename
+
+    with filelock.FileLock(xdg_cache_home / f'{filename}.lock'):
+        if not local_path.exists():
+            labels, mfccs = compute_google_speech_mfccs(start, limit)
+            tmp_path = local_path.with_name(filename + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, labels=labels, mfccs=mfccs)
+            os.replace(tmp_path, local_path)
+
+        with np.load(local_path) as cached:
+            labels = cached['labels'].tolist()
+            mfccs = cached['mfccs']
+
+    return ModelData(labels=labels, images=mfccs, data_layout=DataLayout.NEUTRAL)
+
+def compute_google_speech_mfccs(start: int, limit: int):
     import tensorflow as tf
     import torchaudio
 
@@ -130,6 +146,8 @@ def load_data_google_speech(start: int, limit: int) -> ModelData:
     mfccs = []
     with tf.compat.v1.Session() as sess:
         mfcc_tensor = sess.graph.get_tensor_by_name('Mfcc:0')
+        # Clips in the dataset may be shorter than one second, so waveforms
+        # cannot be stacked into a single run
         for decoded_wav in decoded_wavs:
             mfcc = sess.run(mfcc_tensor, {
                 'decoded_sample_data:0': decoded_wav,
@@ -137,8 +155,7 @@ def load_data_google_speech(start: int, limit: int) -> ModelData:
             })
             mfccs.append(mfcc[0])
 
-
-    return ModelData(labels=labels, images=np.array(mfccs, dtype=np.float32), data_layout=DataLayout.NEUTRAL)
+    return labels, np.array(mfccs, dtype=np.float32)
 
 def kws_dnn_model():
     return download_file('https://github.com/ARM-software/ML-KWS-for-MCU/raw/master/Pretrained_models/DNN/DNN_S.pb', 'KWS-DNN_S.pb')
@@ -184,6 +201,15 @@ def download_file(url: str, filename: str, post_processor: Optional[Callable] =
 
     return ret
 
+def decode_raw_data(params):
+    # raw_data is always stored in little-endian order (see onnx.proto)
+    dtype = {
+        onnx.TensorProto.FLOAT: '<f4',
+        onnx.TensorProto.INT64: '<i8',
+    }[params.data_type]
+    # The returned array is read-only, as it shares memory with params.raw_data
+    return np.frombuffer(params.raw_data, dtype=dtype)
+
 def extract_data(params):
     if params.data_type == onnx.TensorProto.FLOAT and params.float_data:
         ret = params.float_data
@@ -191,11 +217,7 @@ def extract_data(params):
         ret = params.int64_data
 
     else:
-        format_char = {
-            onnx.TensorProto.FLOAT: 'f',
-            onnx.TensorProto.INT64: 'q',
-        }[params.data_type]
-        ret = list(map(lambda t: t[0], struct.iter_unpack(format_char, params.raw_data)))
+        ret = decode_raw_data(params)
 
     # Undocumented (?) - empty dims means scalar
     # https://github.com/onnx/onnx/issues/1131
@@ -205,18 +227,40 @@ def extract_data(params):
 
     return np.reshape(ret, params.dims)
 
-def find_initializer(onnx_model: onnx.ModelProto, name: str) -> Optional[onnx.TensorProto]:
+def initializer_index(onnx_model: onnx.ModelProto) -> Dict[str, onnx.TensorProto]:
+    return {initializer.name: initializer for initializer in onnx_model.graph.initializer}
+
+def value_info_index(onnx_model: onnx.ModelProto) -> Dict[str, onnx.ValueInfoProto]:
+    g = onnx_model.graph
+    index = {}
+    for value_info in itertools.chain(g.value_info, g.input, g.output):
+        # Keep the first match, as a linear scan would do
+        index.setdefault(value_info.name, value_info)
+    return index
+
+# Indices from initializer_index() and value_info_index() avoid linear scans for
+# lookups in loops. They are not updated when the graph is modified.
+def find_initializer(onnx_model: onnx.ModelProto, name: str,
+                     index: Optional[Dict[str, onnx.TensorProto]] = None) -> Optional[onnx.TensorProto]:
+    if index is not None:
+        return index.get(name)
     for initializer in onnx_model.graph.initializer:
         if initializer.name == name:
             return initializer
 
-def find_tensor_value_info(onnx_model: onnx.ModelProto, name: str) -> onnx.ValueInfoProto:
+def find_tensor_value_info(onnx_model: onnx.ModelProto, name: str,
+                           index: Optional[Dict[str, onnx.ValueInfoProto]] = None) -> onnx.ValueInfoProto:
     if name.endswith('_before_merge'):
         name = name[:-len('_before_merge')]
-    g = onnx_model.graph
-    for value_info in itertools.chain(g.value_info, g.input, g.output):
-        if value_info.name == name:
+    if index is not None:
+        value_info = index.get(name)
+        if value_info is not None:
             return value_info
+    else:
+        g = onnx_model.graph
+        for value_info in itertools.chain(g.value_info, g.input, g.output):
+            if value_info.name == name:
+                return value_info
     raise ValueError(f'No value_info found for {name}')
 
 def find_node_by_output(nodes: List[onnx.NodeProto], output_name: str) -> onnx.NodeProto:
@@ -261,11 +305,18 @@ def load_model(config, for_deployment):
     change_batch_size(onnx_model)
 
     # https://zhuanlan.zhihu.com/p/41255090
+    # fuse_consecutive_transposes is not used, as transform.py treats Transpose
+    # nodes as no-ops for layout conversion
     onnx_model = onnxoptimizer.optimize(onnx_model, [
+        'eliminate_deadend',
+        'eliminate_identity',
         'eliminate_nop_dropout',
+        'eliminate_nop_pad',
         'extract_constant_to_initializer',
+        'fuse_bn_into_conv',
         'fuse_add_bias_into_conv',
         'fuse_matmul_add_bias_into_gemm',
+        'fuse_consecutive_squeezes',
     ])
 
     dynamic_shape_inference(onnx_model, config['sample_size'])
@@ -294,33 +345,66 @@ def add_merge_nodes(model):
     del model.graph.node[:]
     model.graph.node.extend(new_nodes)
 
-def onnxruntime_prepare_model(model):
+# intra_op_num_threads=0 means using ONNX Runtime's default
+def onnxruntime_prepare_model(model, intra_op_num_threads: int = 0):
+    # ModelProto objects are mutable and unhashable, so sessions are cached by
+    # the serialized model instead
+    return _onnxruntime_prepare_serialized_model(model.SerializeToString(), intra_op_num_threads)
+
+@functools.lru_cache(maxsize=8)
+def _onnxruntime_prepare_serialized_model(serialized_model: bytes, intra_op_num_threads: int):
+    # https://onnxruntime.ai/docs/performance/graph-optimizations.html
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    sess_options.enable_mem_pattern = True
+    sess_options.enable_cpu_mem_arena = True
     return backend.prepare(onnxruntime.InferenceSession(
-        model.SerializeToString(),
+        serialized_model,
+        sess_options,
         providers=["CPUExecutionProvider"],
     ))
 
 def onnxruntime_get_intermediate_tensor(model, image):
+    yield from onnxruntime_prepare_intermediate_model(model)(image)
+
+# Returns a function that yields (name, op type, value) for each intermediate
+# tensor of the given input. The model is serialized only once, so the returned
+# function can be used for multiple inputs cheaply.
+def onnxruntime_prepare_intermediate_model(model):
     # Creating a new model with all nodes as outputs
     # https://github.com/microsoft/onnxruntime/issues/1455#issuecomment-979901463
-    tmp_model = onnx.ModelProto()
-    tmp_model.CopyFrom(model)
+    # Outputs of the given model are modified in place and restored afterwards,
+    # as copying the whole model, including weights, is expensive
+    orig_outputs = list(model.graph.output)
+    orig_output_names = set(output.name for output in orig_outputs)
+    try:
+        del model.graph.output[:]
+        for node in model.graph.node:
+            for output in node.output:
+                if output not in orig_output_names:
+                    model.graph.output.append(onnx.ValueInfoProto(name=output))
+        model.graph.output.extend(orig_outputs)
+
+        output_names = [output.name for output in model.graph.output]
+        rep = onnxruntime_prepare_model(model)
+    finally:
+        del model.graph.output[:]
+        model.graph.output.extend(orig_outputs)
 
-    orig_outputs = list(tmp_model.graph.output)
-    orig_output_names = [node.name for node in orig_outputs]
-    del tmp_model.graph.output[:]
-    for node in tmp_model.graph.node:
-        for output in node.output:
-            if output not in orig_output_names:
-                tmp_model.graph.output.append(onnx.ValueInfoProto(name=output))
-    tmp_model.graph.output.extend(orig_outputs)
+    op_types = {
+        output: node.op_type
+        for node in model.graph.node
+        for output in node.output
+    }
 
-    rep = onnxruntime_prepare_model(tmp_model)
-    outputs = rep.run(image)
-    for idx, output in enumerate(outputs):
-        output_name = tmp_model.graph.output[idx].name
-        node = find_node_by_output(tmp_model.graph.node, output_name)
-        yield output_name, node.op_type, output
+    def run(image):
+        outputs = rep.run(image)
+        for output_name, output in zip(output_names, outputs):
+            yield output_name, op_types[output_name], output
+
+    return run
 
 def change_batch_size(onnx_model: onnx.ModelProto):
     g = onnx_model.graph
@@ -333,8 +417,11 @@ def change_batch_size(onnx_model: onnx.ModelProto):
         if shape.dim and shape.dim[0].dim_param:
             shape.dim[0].dim_value = 1
 
-    # make sure above steps did not break the model
-    onnx.shape_inference.infer_shapes(onnx_model)
+    # make sure above steps did not break the model. infer_shapes returns a new
+    # model, so this is only a (not cheap) validation step and is skipped
+    # unless debugging.
+    if logger.isEnabledFor(logging.DEBUG):
+        onnx.shape_inference.infer_shapes(onnx_model, strict_mode=True)
 
 def dynamic_shape_inference(onnx_model: onnx.ModelProto, sample_size: Iterable[int]) -> None:
     for node in itertools.chain(onnx_model.graph.input, onnx_model.graph.output):
@@ -346,17 +433,19 @@ def dynamic_shape_inference(onnx_model: onnx.ModelProto, sample_size: Iterable[i
 
     BATCH_SIZE = 2  # Any number larger than 1 is OK. Here I pick the smallest one for performance considerations
 
+    get_intermediate_tensor = onnxruntime_prepare_intermediate_model(onnx_model)
+
     dummy_images = np.expand_dims(np.zeros(sample_size, dtype=np.float32), axis=0)
     shapes = {
         layer_name: np.shape(layer_out)
-        for layer_name, _, layer_out in onnxruntime_get_intermediate_tensor(onnx_model, dummy_images)
+        for layer_name, _, layer_out in get_intermediate_tensor(dummy_images)
     }
     dummy_images = np.concatenate([
         np.expand_dims(np.random.rand(*sample_size).astype(np.float32), axis=0) for _ in range(BATCH_SIZE)
     ], axis=0)
 
     value_infos = []
-    for layer_name, layer_type, layer_out in onnxruntime_get_intermediate_tensor(onnx_model, dummy_images):
+    for layer_name, layer_type, layer_out in get_intermediate_tensor(dummy_images):
         larger_shape = np.shape(layer_out)
         smaller_shape = shapes[layer_name]
         if larger_shape[1:] != smaller_shape[1:]:
@@ -389,9 +478,10 @@ def remap_inputs(model: onnx.ModelProto, input_mapping: Dict[str, str]):
             output + '_unused' if output in new_inputs else output
             for output in node.output
         ]
-    for idx, inp in enumerate(model.graph.input):
-        if inp.name in input_mapping.keys():
-            del model.graph.input[idx]
+    # Deleting items while iterating skips the item after each deleted one
+    new_graph_inputs = [inp for inp in model.graph.input if inp.name not in input_mapping]
+    del model.graph.input[:]
+    model.graph.input.extend(new_graph_inputs)
 
     return onnxoptimizer.optimize(model, ['eliminate_deadend'])
 
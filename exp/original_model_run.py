@@ -1,4 +1,6 @@
 import argparse
+import concurrent.futures
+import os
 import pathlib
 import sys
 
@@ -11,8 +13,10 @@ sys.path.append(str(TOPDIR))
 from configs import configs
 from utils import dynamic_shape_inference, onnxruntime_prepare_model, onnxruntime_get_intermediate_tensor, load_model, import_model_output_pb2
 
-def print_float(val):
-    print('%13.6f' % val, end='')
+def print_rows(rows):
+    # np.savetxt formats a whole row at once, which is much faster than
+    # formatting and printing values one by one
+    np.savetxt(sys.stdout, rows, fmt='%13.6f', delimiter='')
 
 def print_tensor(tensor, print_histogram):
     shape = np.shape(tensor)
@@ -23,36 +27,28 @@ def print_tensor(tensor, print_histogram):
         assert N == 1
         for c in range(C):
             print(f'Channel {c}')
-            for h in range(H):
-                for w in range(W):
-                    print_float(tensor[0, c, h, w])
-                print()
+            print_rows(tensor[0, c])
             print()
     elif dimensions == 3:
         N, C, W = shape
         for n in range(N):
             for c in range(C):
                 print(f'Channel {c}')
-                for w in range(W):
-                    print_float(tensor[n, c, w])
-                print()
+                print_rows(tensor[n, c:c+1])
                 print()
             print()
     elif dimensions == 2:
-        H, W = shape
-        for h in range(H):
-            for w in range(W):
-                print_float(tensor[h, w])
-            print()
+        print_rows(tensor)
     elif dimensions == 1:
         if shape[0] >= 1024:
             print(f'Skipping very long vector with length {shape[0]}')
             return
-        for idx in range(shape[0]):
-            print_float(tensor[idx])
-            if idx % 16 == 15:
-                print()
-        print()
+        n_rows, remaining = divmod(shape[0], 16)
+        print_rows(np.reshape(tensor[:n_rows*16], (n_rows, 16)))
+        if remaining:
+            print_rows(np.reshape(tensor[n_rows*16:], (1, remaining)))
+        else:
+            print()
     else:
         print(f'Skip: unsupported {dimensions}-dimensional array')
     if dimensions >= 1 and np.prod(shape) != 0:
@@ -110,14 +106,23 @@ def run_model(model, model_data, limit, verbose=True, save_file=None):
                 f.write(model_output.SerializeToString())
         return last_layer_out
     else:
-        correct = 0
-        layer_outs = onnxruntime_prepare_model(model).run(model_data.images)[0]
-        for idx, layer_out in enumerate(layer_outs):
-            predicted = np.argmax(layer_out)
-            if predicted == model_data.labels[idx]:
-                if verbose:
-                    print(f'Correct at idx={idx}')
-                correct += 1
+        # No copy for loaders that already return a contiguous float32 batch
+        images = np.ascontiguousarray(model_data.images, dtype=np.float32)
+        # ONNX Runtime does not split a batch across threads. For the small models
+        # here, concurrent single-threaded runs over shards of the batch keep all
+        # cores busy better than intra-op parallelism.
+        n_workers = os.cpu_count() or 1
+        rep = onnxruntime_prepare_model(model, intra_op_num_threads=1)
+        shards = [shard for shard in np.array_split(images, n_workers) if len(shard)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as pool:
+            layer_outs = np.concatenate(list(pool.map(lambda shard: rep.run(shard)[0], shards)))
+        # Flatten outputs of each sample, as np.argmax without axis does
+        predicted = np.argmax(np.reshape(layer_outs, (len(layer_outs), -1)), axis=1)
+        is_correct = predicted == np.asarray(model_data.labels)
+        if verbose:
+            for idx in np.flatnonzero(is_correct):
+                print(f'Correct at idx={idx}')
+        correct = np.count_nonzero(is_correct)
         total = len(model_data.labels)
         accuracy = correct/total
         if verbose: